@@ -11,8 +11,8 @@ HEIGHT = 540
 REFRESH_RATE = 1 / 60
 START_OPACITY = 255
 END_OPACITY = 0
-MIN_START_VEL = np.array([-5, -3], dtype=float) / REFRESH_RATE
-MAX_START_VEL = np.array([5, -2], dtype=float) / REFRESH_RATE
+MIN_START_VEL = np.array([-5, -3], dtype=np.float32) / REFRESH_RATE
+MAX_START_VEL = np.array([5, -2], dtype=np.float32) / REFRESH_RATE
 MIN_LIFESPAN = 1
 MAX_LIFESPAN = 4
 MASS_SCALE = 3
@@ -20,10 +20,13 @@ MAX_COUNT = 1000
 EMISSION_COUNT = 20
 SPEED_X = 300
 SPEED_Y = SPEED_X * (HEIGHT / WIDTH)
+SPEED = np.array([SPEED_X, SPEED_Y], dtype=np.float32)
 # Amount of seconds until next particle emission
 EMISSION_RATE = 1 / 12
 timer = time.time()
 paused = True
+# Particle count shown in the label, to update its text only when it changes
+label_count = -1
 
 
 window = pyglet.window.Window(width=WIDTH, height=HEIGHT, vsync=False)
@@ -38,26 +41,21 @@ keys = key.KeyStateHandler()
 window.push_handlers(keys)
 
 
-particle_img = pyglet.image.load("particle.png")
+# Place the image in an atlas so every particle quad shares one texture
+texture_bin = pyglet.image.atlas.TextureBin()
+particle_img = texture_bin.add(pyglet.image.load("particle.png"))
 particle_system = ParticleSystem(particle_img, MAX_COUNT)
-emission_x = 480
-emission_y = 500
+emission = np.array([480, 500], dtype=np.float32)
 
 
 def update_particles(dt):
-    if paused:
-        return
-    global emission_x, emission_y, timer
+    global emission, timer
     particle_system.update(dt)
-    # Move emitter from input
-    if keys[key.LEFT]:
-        emission_x -= SPEED_X * dt
-    elif keys[key.RIGHT]:
-        emission_x += SPEED_X * dt
-    if keys[key.UP]:
-        emission_y += SPEED_Y * dt
-    elif keys[key.DOWN]:
-        emission_y -= SPEED_Y * dt
+    # Move emitter from input, opposite keys cancel each other
+    direction = np.array([
+        keys[key.RIGHT] - keys[key.LEFT], keys[key.UP] - keys[key.DOWN]
+    ], dtype=np.float32)
+    emission += SPEED * dt * direction
     # Emit particles
     timer += dt
     if timer > EMISSION_RATE:
@@ -74,18 +72,19 @@ def update_particles(dt):
             start_m, end_m
         )
         particle_system.emit(
-            emission_x, emission_y, EMISSION_COUNT, particle_settings,
+            emission[0], emission[1], EMISSION_COUNT, particle_settings,
             MIN_START_VEL, MAX_START_VEL
         )
 
 
 @window.event
 def on_draw():
+    global label_count
     window.clear()
     fps_display.draw()
-    label.text = "Number of active particles: {}".format(
-        len(particle_system.particles)
-    )
+    if particle_system.count != label_count:
+        label_count = particle_system.count
+        label.text = f"Number of active particles: {label_count}"
     label.draw()
     particle_system.draw()
     if paused:
@@ -96,6 +95,11 @@ def on_key_press(symbol, _):
     global paused
     if symbol == key.SPACE:
         paused = not paused
+        # Only update while running and at a fixed rate
+        if paused:
+            pyglet.clock.unschedule(update_particles)
+        else:
+            pyglet.clock.schedule_interval(update_particles, REFRESH_RATE)
     elif symbol == key.S:
         pyglet.image.get_buffer_manager().get_color_buffer().save(
             'screenshot.png'
@@ -104,5 +108,4 @@ def on_key_press(symbol, _):
 
 if __name__ == "__main__":
     window.push_handlers(on_key_press=on_key_press)
-    pyglet.clock.schedule(update_particles)
     pyglet.app.run()
@@ -1,11 +1,24 @@
 from dataclasses import dataclass
+from numba import njit, prange
 import numpy as np
 import pyglet
-import time
+from pyglet.gl import (
+    GL_BLEND, GL_COLOR_BUFFER_BIT, GL_ONE_MINUS_SRC_ALPHA, GL_QUADS,
+    GL_SRC_ALPHA, glBlendFunc, glEnable, glPopAttrib, glPushAttrib
+)
 
 
-# Local modules
-from pyglet_particles.physics import State
+# Number of particles each thread updates at a time, small enough for all of
+# their arrays to stay in cache
+BLOCK_SIZE = 4096
+# Particle arrays are padded to a multiple of this many entries, enough for
+# a full AVX-512 register of float32 values
+SIMD_WIDTH = 16
+# Flags of the values that change during the life of a particle, the other
+# values keep their start value and are not interpolated
+LERP_COLOR = 1
+LERP_MASS = 2
+LERP_OPACITY = 4
 
 
 @dataclass
@@ -13,6 +26,9 @@ class ParticleSettings:
     """
     Settings for a particle including color, opacity, lifespan and mass ranges
 
+    The settings are only read when particles are emitted, their values are
+    copied into the arrays of the system so updates never touch them.
+
     Attributes:
         start_color (ndarray): Color the particles have at the beginning
         end_color (ndarray): Color at the end of the lifespan RGB in 0-255
@@ -33,82 +49,207 @@ class ParticleSettings:
     end_m: float
 
 
-class Particle:
+def aligned_empty(shape, dtype, align=64):
     """
-    Particle that represents a unit of a particle system and displays a
-    sprite.
+    Create an uninitialized array whose data starts at an aligned address.
 
-    Attributes:
-        sprite (Sprite): Sprite that represents the particle
-        state (State): Object that stores the physical state
-        creation_time (float): Time when the particle was created
-        settings (ParticleSettings): A collection of settings for a particle
-        dead (bool): If this particle reached its lifespan
-        lifespan (float): Life duration of the particle in seconds
+    Args:
+        shape (int | tuple[int]): Shape of the array
+        dtype (dtype): Data type of the array
+        align (int): Alignment of the data in bytes, a cache line by default
+
+    Returns:
+        ndarray: The new array
     """
-    def __init__(self, sprite, state, creation_time, settings):
-        self.sprite = sprite
-        self.state = state
-        self.creation_time = creation_time
-        self.settings = settings
-        self.dead = False
-        self.lifespan = np.random.uniform(
-            settings.min_lifespan, settings.max_lifespan
-        )
-        self.sprite.color = settings.start_color
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    buffer = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -buffer.ctypes.data % align
+    return buffer[offset:offset + nbytes].view(dtype).reshape(shape)
 
-    def update(self, dt, current_time, forces):
-        """
-        Update if the particle is dead, its physical state and color
 
-        Args:
-            dt (float): Seconds since the last update
-            current_time (float): Current time in seconds
-            forces (list[float]): List of forces acting on the particle
-        """
-        # Set dead particles
-        elapsed_time = current_time - self.creation_time
-        if elapsed_time > self.lifespan:
-            self.dead = True
-            return
-        # Life time interpolation value value
-        t = elapsed_time / self.lifespan
-        # Update physical state
-        self.state.m = (
-            (1 - t) * self.settings.start_m + t * self.settings.end_m
-        )
-        self.state.pos += self.state.v * dt
-        self.sprite.update(x=self.state.pos[0], y=self.state.pos[1])
-        for force in forces:
-            a = force / self.state.m
-            self.state.v += a * dt
-        # Update color
-        self.sprite.color = (
-            (1 - t) * self.settings.start_color + t * self.settings.end_color
-        )
-        self.sprite.opacity = (
-            (1 - t) * self.settings.start_opacity +
-            t * self.settings.end_opacity
-        )
+@njit(parallel=True, fastmath=True, cache=True)
+def _update_kernel(
+    pos, v, m, creation_time, lifespan, start_m, end_m, flags, fx, fy,
+    current_time, dt, n, t, dead
+):
+    """
+    Update the physical state of the first n particles in a single pass,
+    going through them in blocks of BLOCK_SIZE particles.
+
+    Args:
+        pos (ndarray): Position of each particle
+        v (ndarray): Velocity of each particle
+        m (ndarray): Mass of each particle at the current state
+        creation_time (ndarray): Time when each particle was created
+        lifespan (ndarray): Life duration of each particle in seconds
+        start_m (ndarray): Mass of each particle at the beginning
+        end_m (ndarray): Mass of each particle at the end of lifespan
+        flags (ndarray): Values that each particle interpolates
+        fx (float): Sum of the forces acting on the particles in the x-axis
+        fy (float): Sum of the forces acting on the particles in the y-axis
+        current_time (float): Current time in seconds
+        dt (float): Seconds since the last update
+        n (int): Number of active particles
+        t (ndarray): Output for the life time interpolation value
+        dead (ndarray): Output mask of the particles that reached their
+            lifespan
+    """
+    for block in prange((n + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        start = block * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, n)
+        for i in range(start, end):
+            elapsed_time = current_time - creation_time[i]
+            if elapsed_time > lifespan[i]:
+                dead[i] = True
+                t[i] = 1
+                continue
+            dead[i] = False
+            t[i] = elapsed_time / lifespan[i]
+            # Mass starts as start_m so it only changes if it is interpolated
+            if flags[i] & LERP_MASS:
+                m[i] = (1 - t[i]) * start_m[i] + t[i] * end_m[i]
+            pos[i, 0] += v[i, 0] * dt
+            pos[i, 1] += v[i, 1] * dt
+            inv_m_dt = dt / m[i]
+            v[i, 0] += fx * inv_m_dt
+            v[i, 1] += fy * inv_m_dt
+
+
+class _BlendGroup(pyglet.graphics.Group):
+    """
+    Group that draws untextured particles with alpha blending.
+    """
+    def set_state(self):
+        glPushAttrib(GL_COLOR_BUFFER_BIT)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+
+    def unset_state(self):
+        glPopAttrib()
 
 
 class ParticleSystem:
     """
     System that can emit particles.
 
+    The particles are stored as a structure of arrays, every array has room for
+    max_count particles and only the first count entries are active. The
+    arrays are aligned to cache lines and padded to a multiple of SIMD_WIDTH
+    entries, the entries after count are dummy particles that are always dead.
+
+    Each particle is drawn as a quad of a vertex list that has room for
+    max_count quads, so the whole system is updated with a single write per
+    attribute and drawn with a single draw call. Rectangle particles use a
+    second untextured vertex list that is created the first time they are
+    emitted.
+
     Attributes:
         img (Image): Image to use for each particle
         max_count (int): Maximum number of particles allowed in the system
-        forces (list[float]): Forces that will affect the system in N
-        particles (list[Particle]): Particles that belong to the system
-        batch (Batch): A batch object that groups sprites in a single draw call
+        forces (ndarray): Forces that will affect the system in N with shape
+            (F, 2)
+        batch (Batch): A batch object that groups the quads in a single draw
+            call
+        count (int): Number of active particles in the system
+        now (float): Seconds the system has been updated for, used as the
+            current time
+        rng (Generator): Random generator for the velocities and lifespans
+        pos (ndarray): Position of each particle
+        v (ndarray): Velocity of each particle
+        m (ndarray): Mass of each particle at the current state
+        creation_time (ndarray): Time when each particle was created
+        lifespan (ndarray): Life duration of each particle in seconds
+        start_m (ndarray): Mass of each particle at the beginning
+        end_m (ndarray): Mass of each particle at the end of lifespan
+        start_color (ndarray): Color of each particle at the beginning
+        end_color (ndarray): Color of each particle at the end of lifespan
+        start_opacity (ndarray): Opacity of each particle at the beginning
+        end_opacity (ndarray): Opacity of each particle at the end of lifespan
+        size (ndarray): Width and height of the quad of each particle
+        anchor (ndarray): Point of the quad of each particle that is placed
+            at its position, measured from the bottom left corner
+        textured (ndarray): If each particle is drawn with the image instead
+            of as a rectangle
+        flags (ndarray): Values that each particle interpolates, a
+            combination of LERP_COLOR, LERP_MASS and LERP_OPACITY
     """
     def __init__(self, img, max_count):
         self.img = img
         self.max_count = max_count
-        self.forces = []
-        self.particles = []
+        self.forces = np.zeros((0, 2), dtype=np.float32)
         self.batch = pyglet.graphics.Batch()
+        self.count = 0
+        self.now = 0.0
+        self.rng = np.random.default_rng()
+        capacity = -(-max_count // SIMD_WIDTH) * SIMD_WIDTH
+        self.pos = aligned_empty((capacity, 2), np.float32)
+        self.v = aligned_empty((capacity, 2), np.float32)
+        self.m = aligned_empty(capacity, np.float32)
+        self.creation_time = aligned_empty(capacity, np.float32)
+        self.lifespan = aligned_empty(capacity, np.float32)
+        self.start_m = aligned_empty(capacity, np.float32)
+        self.end_m = aligned_empty(capacity, np.float32)
+        self.start_color = aligned_empty((capacity, 3), np.uint8)
+        self.end_color = aligned_empty((capacity, 3), np.uint8)
+        self.start_opacity = aligned_empty(capacity, np.uint8)
+        self.end_opacity = aligned_empty(capacity, np.uint8)
+        self.size = aligned_empty((capacity, 2), np.float32)
+        self.anchor = aligned_empty((capacity, 2), np.float32)
+        self.textured = aligned_empty(capacity, np.bool_)
+        self.flags = aligned_empty(capacity, np.uint8)
+        # Arrays that hold one entry per particle
+        self._arrays = (
+            self.pos, self.v, self.m, self.creation_time, self.lifespan,
+            self.start_m, self.end_m, self.start_color, self.end_color,
+            self.start_opacity, self.end_opacity, self.size, self.anchor,
+            self.textured, self.flags
+        )
+        self.creation_time[:] = 0
+        self.lifespan[:] = -1
+        # Scratch buffers reused by every update
+        self._t = aligned_empty(capacity, np.float32)
+        self._dead = aligned_empty(capacity, np.bool_)
+        self._t256 = aligned_empty(capacity, np.uint16)
+        self._inv_t256 = aligned_empty(capacity, np.uint16)
+        self._colors = aligned_empty((capacity, 3), np.uint16)
+        self._opacities = aligned_empty(capacity, np.uint16)
+        self._quads = aligned_empty((capacity, 4, 2), np.float32)
+        # Vertex lists with one quad per particle
+        texture = img.get_texture()
+        self._sprite_quads = self._create_quads(
+            pyglet.sprite.SpriteGroup(
+                texture, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA
+            ),
+            ('t3f/static', texture.tex_coords * max_count)
+        )
+        self._rect_quads = None
+
+    def add_force(self, force):
+        """
+        Add a force that will affect every particle in the system.
+
+        Args:
+            force (ndarray): Force in N for the x-axis and y-axis
+        """
+        self.forces = np.vstack(
+            (self.forces, np.asarray(force, dtype=np.float32))
+        )
+
+    def _create_quads(self, group, *data):
+        """
+        Add a vertex list with room for max_count quads to the batch.
+
+        Args:
+            group (Group): Group that sets the state to draw the quads
+            *data: Extra vertex attributes besides positions and colors
+
+        Returns:
+            VertexList: The new vertex list
+        """
+        return self.batch.add(
+            4 * self.max_count, GL_QUADS, group, 'v2f/stream', 'c4B/stream',
+            *data
+        )
 
     def emit(self, x, y, num, settings, min_start_velocity, max_start_velocity):
         """
@@ -124,27 +265,16 @@ class ParticleSystem:
             max_start_velocity (ndarray): Maximum velocity at start
 
         Returns:
-            list[Particles]: The new particles created
-        """
-        creation_time = time.time()
-        new_particles = []
-        for i in range(num):
-            # if limit was reached break
-            if len(self.particles) + i == self.max_count:
-                break
-            sprite = pyglet.sprite.Sprite(self.img, x, y, batch=self.batch)
-            pos = np.array([x, y], dtype=float)
-            v = np.zeros(len(min_start_velocity))
-            for i in range(len(min_start_velocity)):
-                v[i] = np.random.uniform(
-                    min_start_velocity[i], max_start_velocity[i]
-                )
-            state = State(pos, v, settings.start_m)
-            particle = Particle(sprite, state, creation_time, settings)
-            new_particles.append(particle)
-        # add new particles to the list
-        self.particles.extend(new_particles)
-        return new_particles
+            int: The number of new particles created
+        """
+        # if limit was reached create only the ones that fit
+        num = min(num, self.max_count - self.count)
+        self._add_particles(
+            num, x, y, settings, min_start_velocity, max_start_velocity,
+            (self.img.width, self.img.height),
+            (self.img.anchor_x, self.img.anchor_y), True
+        )
+        return num
 
     def emit_rect(
         self, x, y, num, settings, min_start_velocity, max_start_velocity,
@@ -165,29 +295,70 @@ class ParticleSystem:
             height (int): Height of rectangles in pixels
 
         Returns:
-            list[Particles]: The new particles created
-        """
-        creation_time = time.time()
-        new_particles = []
-        for i in range(num):
-            # if limit was reached break
-            if len(self.particles) + i == self.max_count:
-                break
-            rect = pyglet.shapes.Rectangle(
-                x, y, width, height, batch=self.batch
-            );
-            pos = np.array([x, y], dtype=float)
-            v = np.zeros(len(min_start_velocity))
-            for i in range(len(min_start_velocity)):
-                v[i] = np.random.uniform(
-                    min_start_velocity[i], max_start_velocity[i]
-                )
-            state = State(pos, v, settings.start_m)
-            particle = Particle(rect, state, creation_time, settings)
-            new_particles.append(particle)
-        # add new particles to the list
-        self.particles.extend(new_particles)
-        return new_particles
+            int: The number of new particles created
+        """
+        if self._rect_quads is None:
+            self._rect_quads = self._create_quads(_BlendGroup())
+        # if limit was reached create only the ones that fit
+        num = min(num, self.max_count - self.count)
+        self._add_particles(
+            num, x, y, settings, min_start_velocity, max_start_velocity,
+            (width, height), (0, 0), False
+        )
+        return num
+
+    def _add_particles(
+        self, num, x, y, settings, min_start_velocity, max_start_velocity,
+        size, anchor, textured
+    ):
+        """
+        Fill the slots after the active particles with new particles.
+
+        Args:
+            num (int): Number of particles to create
+            x (float): Position of the emission in the x-axis
+            y (float): Position of the emission in the y-axis
+            settings (ParticleSettings): Settings for the particles
+            min_start_velocity (ndarray): Minimum velocity at start
+            max_start_velocity (ndarray): Maximum velocity at start
+            size (tuple[float]): Width and height of the particles
+            anchor (tuple[float]): Anchor point of the particles
+            textured (bool): If the particles are drawn with the image
+        """
+        new = slice(self.count, self.count + num)
+        # Draw the random values straight into the new slots
+        v = self.v[new]
+        self.rng.random(dtype=np.float32, out=v)
+        v *= np.subtract(max_start_velocity, min_start_velocity)
+        v += min_start_velocity
+        lifespan = self.lifespan[new]
+        self.rng.random(dtype=np.float32, out=lifespan)
+        lifespan *= settings.max_lifespan - settings.min_lifespan
+        lifespan += settings.min_lifespan
+        self.pos[new] = (x, y)
+        self.m[new] = settings.start_m
+        self.creation_time[new] = self.now
+        self.start_m[new] = settings.start_m
+        self.end_m[new] = settings.end_m
+        self.start_color[new] = settings.start_color
+        self.end_color[new] = settings.end_color
+        self.start_opacity[new] = settings.start_opacity
+        self.end_opacity[new] = settings.end_opacity
+        self.size[new] = size
+        self.anchor[new] = anchor
+        self.textured[new] = textured
+        # Skip the interpolation of the values that stay the same
+        flags = 0
+        if not np.array_equal(self.start_color[new], self.end_color[new]):
+            flags |= LERP_COLOR
+        if np.float32(settings.start_m) != np.float32(settings.end_m):
+            flags |= LERP_MASS
+        if not np.array_equal(
+            self.start_opacity[new], self.end_opacity[new]
+        ):
+            flags |= LERP_OPACITY
+        self.flags[new] = flags
+        self.count += num
 
     def update(self, dt):
         """
@@ -196,13 +367,110 @@ class ParticleSystem:
         Args:
             dt (float): Amount of seconds since the last update
         """
-        current_time = time.time()
-        for particle in self.particles:
-            particle.update(dt, current_time, self.forces)
+        self.now += dt
+        n = self.count
+        # Include the dummy particles up to the padding so the kernel works
+        # on whole SIMD registers
+        padded_n = -(-n // SIMD_WIDTH) * SIMD_WIDTH
+        # The forces are the same for every particle so only their sum matters
+        fx, fy = self.forces.sum(axis=0)
+        # Update physical state and set dead particles
+        _update_kernel(
+            self.pos, self.v, self.m, self.creation_time, self.lifespan,
+            self.start_m, self.end_m, self.flags, fx, fy, self.now, dt,
+            padded_n, self._t, self._dead
+        )
         # Remove dead particles
-        for particle in filter(lambda l: l.dead, self.particles):
-            self.particles.remove(particle)
-            particle.sprite.delete()
+        dead = self._dead[:n]
+        if dead.any():
+            self._remove_dead(dead)
+            n = self.count
+        # Life time interpolation value
+        t = self._t[:n]
+        # Values interpolated by at least one particle, the ones that keep
+        # their start value give it back when blended so they can share the
+        # interpolation pass
+        lerp_flags = np.bitwise_or.reduce(self.flags[:n])
+        # Update color interpolating in 8.8 fixed point, the weights add up
+        # to 256 so the blended 8-bit values fit in 16 bits
+        if lerp_flags & (LERP_COLOR | LERP_OPACITY):
+            t256 = self._t256[:n]
+            np.multiply(t, 256, out=t256, casting='unsafe')
+            inv_t256 = self._inv_t256[:n]
+            np.subtract(256, t256, out=inv_t256)
+        if lerp_flags & LERP_COLOR:
+            colors = self._colors[:n]
+            np.multiply(
+                inv_t256[:, np.newaxis], self.start_color[:n], out=colors
+            )
+            colors += t256[:, np.newaxis] * self.end_color[:n]
+            colors >>= 8
+        else:
+            colors = self.start_color[:n]
+        if lerp_flags & LERP_OPACITY:
+            opacities = self._opacities[:n]
+            np.multiply(inv_t256, self.start_opacity[:n], out=opacities)
+            opacities += t256 * self.end_opacity[:n]
+            opacities >>= 8
+        else:
+            opacities = self.start_opacity[:n]
+        self._update_quads(colors, opacities)
+
+    def _update_quads(self, colors, opacities):
+        """
+        Write the quads of the active particles to the vertex lists, the
+        quads of the free slots are collapsed to a point so nothing is drawn.
+
+        Args:
+            colors (ndarray): Color of each active particle
+            opacities (ndarray): Opacity of each active particle
+        """
+        n = self.count
+        # Corners of each quad starting at the bottom left one, in the same
+        # order as the texture coordinates
+        quads = self._quads[:n]
+        np.subtract(
+            self.pos[:n, np.newaxis], self.anchor[:n, np.newaxis], out=quads
+        )
+        quads[:, 1:3, 0] += self.size[:n, np.newaxis, 0]
+        quads[:, 2:4, 1] += self.size[:n, np.newaxis, 1]
+        textured = self.textured[:n]
+        for vertex_list, visible in (
+            (self._sprite_quads, textured), (self._rect_quads, ~textured)
+        ):
+            if vertex_list is None:
+                continue
+            vertices = np.ctypeslib.as_array(vertex_list.vertices)
+            vertices = vertices.reshape(-1, 4, 2)
+            np.multiply(
+                quads, visible[:, np.newaxis, np.newaxis], out=vertices[:n]
+            )
+            vertices[n:] = 0
+            vertex_colors = np.ctypeslib.as_array(vertex_list.colors)
+            vertex_colors = vertex_colors.reshape(-1, 4, 4)
+            vertex_colors[:n, :, :3] = colors[:, np.newaxis]
+            vertex_colors[:n, :, 3] = opacities[:, np.newaxis]
+
+    def _remove_dead(self, dead):
+        """
+        Fill the slots of dead particles with the alive particles from the end
+        of the arrays.
+
+        Args:
+            dead (ndarray): Mask of the active particles that are dead
+        """
+        count = self.count - np.count_nonzero(dead)
+        # Dead slots that stay inside the active range and alive particles
+        # that are left outside of it come in equal numbers
+        holes = np.flatnonzero(dead[:count])
+        movers = count + np.flatnonzero(~dead[count:])
+        for array in self._arrays:
+            array[holes] = array[movers]
+        # The interpolation values of this update move with their particles
+        self._t[holes] = self._t[movers]
+        # Slots left behind become dummy particles
+        self.lifespan[count:self.count] = -1
+        self.count = count
 
     def draw(self):
         self.batch.draw()